@@ -2,8 +2,65 @@ import unittest
 import json
 import os
 import tempfile
+import time
+import gzip
+import shutil
+import signal
+import multiprocessing
+from zipfile import ZipFile
 
-from xml_to_json.convert_xml_to_json import parse_file
+import xmlschema
+
+from xml_to_json.convert_xml_to_json import parse_file, get_schema, schedule_tasks, estimate_memory, convert_xml_to_json, json_decoder, ParqConverter
+from xml_to_json.convert_xml_to_json import _TASK_MEMORY_BASE, _TREE_MEMORY_FACTOR, _XPATH_MEMORY_FACTOR
+
+# memory held by _growing_task for the life of the worker process
+_held = []
+
+
+def _timed_task(tmpdir, name, seconds=0.3):
+    start = time.time()
+    time.sleep(seconds)
+    with open(os.path.join(tmpdir, name + ".span"), "w") as f:
+        f.write(str(start) + " " + str(time.time()))
+
+
+def _read_spans(tmpdir):
+    spans = []
+    for name in os.listdir(tmpdir):
+        with open(os.path.join(tmpdir, name)) as f:
+            spans.append(tuple(float(v) for v in f.read().split()))
+    return spans
+
+
+def _killing_task(tmpdir, name):
+    marker = os.path.join(tmpdir, name + ".killed")
+    if name == "always" or (name == "once" and not os.path.isfile(marker)):
+        open(marker, "w").close()
+        os.kill(os.getpid(), signal.SIGKILL)
+    open(os.path.join(tmpdir, name + ".done"), "w").close()
+
+
+def _killed_timed_task(tmpdir, name):
+    marker = os.path.join(tmpdir, name + ".killed")
+    if name == "once" and not os.path.isfile(marker):
+        open(marker, "w").close()
+        os.kill(os.getpid(), signal.SIGKILL)
+    _timed_task(tmpdir, name)
+
+
+def _growing_task(tmpdir, name):
+    _held.append(bytearray(b"x" * 32 * 1024 * 1024))
+    with open(os.path.join(tmpdir, name + ".pid"), "w") as f:
+        f.write(str(os.getpid()))
+
+
+def _read_pids(tmpdir):
+    pids = []
+    for name in os.listdir(tmpdir):
+        with open(os.path.join(tmpdir, name)) as f:
+            pids.append(f.read())
+    return pids
 
 
 class MyTest(unittest.TestCase):
@@ -67,5 +124,246 @@ class MyTest(unittest.TestCase):
         print(target_json)
         self.assertEqual(target_json, test_json)
 
+    def test_element_plan(self):
+
+        realpath = os.path.dirname(os.path.realpath(__file__))
+
+        input_file = os.path.join(realpath, "PurchaseOrder.xml")
+        xsd_file = os.path.join(realpath, "PurchaseOrder.xsd")
+
+        my_schema = get_schema(xsd_file)
+        self.assertIs(get_schema(xsd_file), my_schema)
+
+        # decode twice so the second pass runs on cached plans
+        for _ in range(2):
+            my_dict = my_schema.to_dict(input_file, process_namespaces=False, validation='skip')
+            with open(os.path.join(realpath, "PurchaseOrder.json")) as f:
+                self.assertEqual(json.loads(json.dumps(my_dict, default=json_decoder)), json.loads(f.read()))
+
+        xsd_elem = my_schema.find("/purchaseOrder/items/item", namespaces=my_schema.namespaces)
+        plan = ParqConverter.element_plan(xsd_elem)
+        self.assertIs(ParqConverter.element_plan(xsd_elem), plan)
+        self.assertIs(ParqConverter.element_plans(xsd_elem)[xsd_elem], plan)
+        self.assertEqual(plan, {"name": "item", "simple": False, "single": False, "attributes": True, "child_count": 5})
+
+        xsd_elem = my_schema.find("/purchaseOrder/items/item/productName", namespaces=my_schema.namespaces)
+        self.assertEqual(ParqConverter.element_plan(xsd_elem), {"name": "productName", "simple": True, "single": True, "attributes": False, "child_count": 0})
+
+        xsd_elem = my_schema.find("/purchaseOrder/items", namespaces=my_schema.namespaces)
+        self.assertEqual(ParqConverter.element_plan(xsd_elem)["child_count"], 1)
+
+        # plans belong to their own schema
+        other_schema = xmlschema.XMLSchema(xsd_file, converter=ParqConverter)
+        other_elem = other_schema.find("/purchaseOrder/items/item", namespaces=other_schema.namespaces)
+        self.assertNotIn(other_elem, ParqConverter.element_plans(xsd_elem))
+
+    def test_build_element_plans(self):
+
+        realpath = os.path.dirname(os.path.realpath(__file__))
+
+        input_file = os.path.join(realpath, "PurchaseOrder.xml")
+        xsd_file = os.path.join(realpath, "PurchaseOrder.xsd")
+
+        my_schema = xmlschema.XMLSchema(xsd_file, converter=ParqConverter)
+        plans = ParqConverter.build_element_plans(my_schema)
+        xsd_elem = my_schema.find("/purchaseOrder/items/item", namespaces=my_schema.namespaces)
+        self.assertIs(ParqConverter.element_plans(xsd_elem), plans)
+        built = dict(plans)
+
+        # decoding finds every plan already built and adds none
+        my_dict = my_schema.to_dict(input_file, process_namespaces=False, validation='skip')
+        with open(os.path.join(realpath, "PurchaseOrder.json")) as f:
+            self.assertEqual(json.loads(json.dumps(my_dict, default=json_decoder)), json.loads(f.read()))
+        self.assertEqual(plans, built)
+        self.assertIn(xsd_elem, plans)
+
+    def test_element_plan_repeated_simple(self):
+
+        list_xsd = """<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+    <xs:element name="list">
+        <xs:complexType>
+            <xs:sequence>
+                <xs:element name="value" type="xs:string" maxOccurs="unbounded"/>
+            </xs:sequence>
+        </xs:complexType>
+    </xs:element>
+</xs:schema>"""
+        list_xml = "<list><value>a</value><value>b</value></list>"
+
+        notes_xsd = """<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+    <xs:element name="order">
+        <xs:complexType>
+            <xs:sequence>
+                <xs:element name="note" maxOccurs="unbounded">
+                    <xs:complexType>
+                        <xs:simpleContent>
+                            <xs:extension base="xs:string">
+                                <xs:attribute name="lang" type="xs:string"/>
+                            </xs:extension>
+                        </xs:simpleContent>
+                    </xs:complexType>
+                </xs:element>
+                <xs:element name="tag" type="xs:string" maxOccurs="unbounded"/>
+            </xs:sequence>
+            <xs:attribute name="id" type="xs:string"/>
+        </xs:complexType>
+    </xs:element>
+</xs:schema>"""
+        notes_xml = '<order id="1"><note lang="en">hi</note><note lang="fr">salut</note><tag>x</tag><tag>y</tag></order>'
+
+        list_schema = xmlschema.XMLSchema(list_xsd, converter=ParqConverter)
+        notes_schema = xmlschema.XMLSchema(notes_xsd, converter=ParqConverter)
+
+        for _ in range(2):
+            self.assertEqual(list_schema.to_dict(list_xml, process_namespaces=False, validation='skip'),
+                             {"list": ["a", "b"]})
+            self.assertEqual(notes_schema.to_dict(notes_xml, process_namespaces=False, validation='skip'),
+                             {"order": {"orderid": "1",
+                                        "note": [{"notelang": "en", "note": "hi"}, {"notelang": "fr", "note": "salut"}],
+                                        "tag": ["x", "y"]}})
+
+        self.assertEqual(ParqConverter.element_plan(list_schema.find("/list"))["child_count"], 1)
+        note_plan = ParqConverter.element_plan(notes_schema.find("/order/note"))
+        self.assertEqual(note_plan, {"name": "note", "simple": True, "single": False, "attributes": True, "child_count": 0})
+
+    def test_schedule_tasks(self):
+
+        realpath = os.path.dirname(os.path.realpath(__file__))
+
+        xsd_file = os.path.join(realpath, "PurchaseOrder.xsd")
+        missing_file = os.path.join(realpath, "Missing.xml")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_file = os.path.join(tmpdir, "PurchaseOrder.jsonl")
+            tasks = [
+                ((os.path.join(realpath, "PurchaseOrder.xml"), output_file, xsd_file, "jsonl", False, "/purchaseOrder/items/item", None, None, None, None, None), 0),
+                ((missing_file, os.path.join(tmpdir, "Missing.jsonl"), xsd_file, "jsonl", False, None, None, None, None, None, None), 0),
+            ]
+
+            failed = schedule_tasks(parse_file, tasks, 2, max_tasks=1)
+            self.assertTrue(os.path.isfile(output_file))
+            self.assertEqual([args[0] for args, error in failed], [missing_file])
+
+    def test_estimate_memory(self):
+
+        realpath = os.path.dirname(os.path.realpath(__file__))
+
+        input_file = os.path.join(realpath, "PurchaseOrder.xml")
+        size = os.path.getsize(input_file)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            gz_file = os.path.join(tmpdir, "PurchaseOrder.xml.gz")
+            with open(input_file, "rb") as f, gzip.open(gz_file, "wb") as g:
+                g.write(f.read())
+
+            zip_file = os.path.join(tmpdir, "PurchaseOrder.zip")
+            with ZipFile(zip_file, "w") as z:
+                z.write(input_file, "1.xml")
+                z.writestr("2.xml", "<purchaseOrder/>")
+
+            for xpath, factor in ((None, _TREE_MEMORY_FACTOR), ("/purchaseOrder/items/item", _XPATH_MEMORY_FACTOR)):
+                expected = _TASK_MEMORY_BASE + size * factor
+                self.assertEqual(estimate_memory(input_file, xpath), expected)
+                self.assertEqual(estimate_memory(gz_file, xpath), expected)
+                self.assertEqual(estimate_memory(zip_file, xpath), expected)
+
+            # corrupt archives fall back to the on disk size
+            bad_zip = os.path.join(tmpdir, "bad.zip")
+            with open(bad_zip, "wb") as f:
+                f.write(b"not a zip file")
+            bad_gz = os.path.join(tmpdir, "bad.gz")
+            with open(bad_gz, "wb") as f:
+                f.write(b"gz")
+            for bad_file in (bad_zip, bad_gz):
+                self.assertEqual(estimate_memory(bad_file, None), _TASK_MEMORY_BASE + os.path.getsize(bad_file) * _TREE_MEMORY_FACTOR)
+
+    def test_convert_corrupt_archive(self):
+
+        realpath = os.path.dirname(os.path.realpath(__file__))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            good_file = os.path.join(tmpdir, "good.xml")
+            shutil.copy(os.path.join(realpath, "PurchaseOrder.xml"), good_file)
+            bad_file = os.path.join(tmpdir, "bad.zip")
+            with open(bad_file, "wb") as f:
+                f.write(b"not a zip file")
+
+            failed = convert_xml_to_json(os.path.join(realpath, "PurchaseOrder.xsd"), xpath="/purchaseOrder/items/item", multi=2, verbose="ERROR", xml_files=[good_file, bad_file])
+            self.assertTrue(os.path.isfile(os.path.join(tmpdir, "good.jsonl")))
+            self.assertEqual([args[0] for args, error in failed], [bad_file])
+
+    def test_schedule_tasks_memory_budget(self):
+
+        # MB scale so worker rss noise after fork does not decide admission
+        mb = 1024 * 1024
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [((tmpdir, str(i)), 100 * mb) for i in range(3)]
+
+            self.assertEqual(schedule_tasks(_timed_task, tasks, 3, memory_budget=150 * mb), [])
+            spans = sorted(_read_spans(tmpdir))
+            self.assertEqual(len(spans), 3)
+            for (start, end), (next_start, next_end) in zip(spans, spans[1:]):
+                self.assertLessEqual(end, next_start)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [((tmpdir, str(i)), 100 * mb) for i in range(3)]
+
+            self.assertEqual(schedule_tasks(_timed_task, tasks, 3, memory_budget=300 * mb), [])
+            spans = sorted(_read_spans(tmpdir))
+            self.assertGreater(spans[0][1], spans[-1][0])
+
+    def test_schedule_tasks_killed_worker(self):
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [((tmpdir, "once"), 0), ((tmpdir, "always"), 0), ((tmpdir, "never"), 0)]
+
+            failed = schedule_tasks(_killing_task, tasks, 2)
+            self.assertEqual([args[1] for args, error in failed], ["always"])
+            self.assertIn(str(-signal.SIGKILL), failed[0][1])
+            self.assertTrue(os.path.isfile(os.path.join(tmpdir, "once.done")))
+            self.assertTrue(os.path.isfile(os.path.join(tmpdir, "never.done")))
+
+    def test_schedule_tasks_retry_alone(self):
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [((tmpdir, "once"), 0), ((tmpdir, "a"), 0), ((tmpdir, "b"), 0)]
+
+            # an unlimited budget must not let the retry share the workers
+            self.assertEqual(schedule_tasks(_killed_timed_task, tasks, 3, memory_budget=float("inf")), [])
+            with open(os.path.join(tmpdir, "once.span")) as f:
+                start, end = [float(v) for v in f.read().split()]
+            for name in ("a", "b"):
+                with open(os.path.join(tmpdir, name + ".span")) as f:
+                    other_start, other_end = [float(v) for v in f.read().split()]
+                self.assertTrue(other_end <= start or end <= other_start)
+
+    def test_schedule_tasks_stops_workers(self):
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # the unpicklable second task raises inside the scheduler loop while the first runs
+            tasks = [((tmpdir, "slow", 5), 0), ((lambda: None,), 0)]
+
+            start = time.time()
+            with self.assertRaises(Exception):
+                schedule_tasks(_timed_task, tasks, 2)
+            self.assertLess(time.time() - start, 4)
+            self.assertEqual(multiprocessing.active_children(), [])
+
+    @unittest.skipUnless(os.path.isfile("/proc/self/status"), "requires /proc")
+    def test_schedule_tasks_rss_growth(self):
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [((tmpdir, str(i)), 0) for i in range(3)]
+
+            self.assertEqual(schedule_tasks(_growing_task, tasks, 1), [])
+            self.assertEqual(len(set(_read_pids(tmpdir))), 1)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tasks = [((tmpdir, str(i)), 0) for i in range(3)]
+
+            self.assertEqual(schedule_tasks(_growing_task, tasks, 1, max_rss_growth=16 * 1024 * 1024), [])
+            self.assertEqual(len(set(_read_pids(tmpdir))), 3)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
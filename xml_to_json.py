@@ -4,9 +4,26 @@
 Author: David Lee
 """
 import argparse
+import sys
 
 from xml_to_json.convert_xml_to_json import convert_xml_to_json
 
+
+def positive_int(value):
+    """
+    :param value: command line value
+    :return: value as a positive int
+    :raises argparse.ArgumentTypeError: value is not a positive int
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError("%r is not a positive integer" % value)
+    return number
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="XML To JSON Parser")
@@ -19,6 +36,9 @@ if __name__ == "__main__":
     parser.add_argument("-a", "--attribpaths", help="extra element attributes to parse out.")
     parser.add_argument("-e", "--excludepaths", help="elements to exclude. pass in comma separated string. /path/exclude1,/path/exclude2")
     parser.add_argument("-m", "--multi", type=int, default=1, help="number of parsers. Default is 1.")
+    parser.add_argument("-b", "--memory_budget", type=positive_int, help="memory in MB shared by concurrent parsers. Default is 80%% of available memory.")
+    parser.add_argument("-r", "--max_tasks", type=positive_int, help="recycle a parser process after this many files.")
+    parser.add_argument("-g", "--max_rss_growth", type=positive_int, help="recycle a parser process once its memory grows by this many MB.")
     parser.add_argument("-l", "--log", help="log file")
     parser.add_argument("-v", "--verbose", default="DEBUG", help="verbose output level. INFO, DEBUG, etc.")
     parser.add_argument("-n", "--no_overwrite", action="store_true", help="do not overwrite output file if it exists already")
@@ -27,4 +47,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    convert_xml_to_json(args.xsd_file, args.output_format, args.server, args.target_path, args.zip, args.xpath, args.attribpaths, args.excludepaths, args.multi, args.no_overwrite, args.verbose, args.log, args.delete_xml, args.input_files)
+    failed = convert_xml_to_json(args.xsd_file, args.output_format, args.server, args.target_path, args.zip, args.xpath, args.attribpaths, args.excludepaths, args.multi, args.no_overwrite, args.verbose, args.log, args.delete_xml, args.input_files, args.memory_budget, args.max_tasks, args.max_rss_growth)
+
+    if failed:
+        sys.exit(1)
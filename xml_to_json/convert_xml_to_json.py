@@ -5,11 +5,14 @@ Author: David Lee
 """
 import xml.etree.cElementTree as ET
 import xmlschema
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import decimal
 import json
 import glob
-from multiprocessing import Pool
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+import pickle
+import struct
 import subprocess
 import os
 import gzip
@@ -17,15 +20,25 @@ import tarfile
 import logging
 import shutil
 import sys
-from zipfile import ZipFile
+from zipfile import ZipFile, BadZipFile
 # import time
 
 from xmlschema.exceptions import XMLSchemaValueError
 from xmlschema.compat import ordered_dict_class
+from xmlschema.validators import XsdElement, XsdAnyElement
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
+# xmlschema objects keyed by xsd file, reused across files parsed by the same process
+_schemas = dict()
+
+# rough multipliers from uncompressed xml size to peak worker memory
+_TREE_MEMORY_FACTOR = 10
+_XPATH_MEMORY_FACTOR = 1
+_GZIP_SIZE_FACTOR = 8
+_TASK_MEMORY_BASE = 32 * 1024 * 1024
+
 
 def json_decoder(obj):
     """
@@ -89,6 +102,56 @@ class ParqConverter(xmlschema.XMLSchemaConverter):
         """
         return False
 
+    @staticmethod
+    def element_plans(xsd_element):
+        """
+        :param xsd_element: The `XsdElement` whose schema plans are wanted.
+        :return: decoding plans keyed by `XsdElement`, stored on the schema's global maps so they live and die with the schema
+        """
+        maps = xsd_element.schema.maps
+        try:
+            return maps.parq_element_plans
+        except AttributeError:
+            maps.parq_element_plans = dict()
+            return maps.parq_element_plans
+
+    @classmethod
+    def element_plan(cls, xsd_element, plans=None):
+        """
+        :param xsd_element: The `XsdElement` to build a decoding plan for.
+        :param plans: optional plan table to look up and store the plan in. Default is the element's schema table
+        :return: cached dictionary of schema derived decoding properties for the element
+        """
+        if plans is None:
+            plans = cls.element_plans(xsd_element)
+        try:
+            return plans[xsd_element]
+        except KeyError:
+            pass
+        xsd_type = getattr(xsd_element, 'type', None)
+        plan = {
+            "name": xsd_element.local_name,
+            "simple": xsd_type is not None and (xsd_type.is_simple() or xsd_type.has_simple_content()),
+            "single": xsd_element.is_single(),
+            "attributes": bool(getattr(xsd_element, 'attributes', None)),
+            "child_count": len(xsd_element.findall("*")),
+        }
+        plans[xsd_element] = plan
+        return plan
+
+    @classmethod
+    def build_element_plans(cls, schema):
+        """
+        :param schema: xmlschema object
+        :return: plan table with a plan for every element declared in the schema
+        """
+        plans = None
+        for xsd_element in schema.iter_components((XsdElement, XsdAnyElement)):
+            if plans is None:
+                plans = cls.element_plans(xsd_element)
+            cls.element_plan(xsd_element, plans)
+        return plans
+
     def element_decode(self, data, xsd_element, level=0):
         """
         :param data: Decoded ElementData from an Element node.
@@ -96,31 +159,37 @@ class ParqConverter(xmlschema.XMLSchemaConverter):
         :param level: 0 for root
         :return: A dictionary-based data structure containing the decoded data.
         """
-        if data.attributes:
-            self.attr_prefix = xsd_element.local_name
-            result_dict = self.dict([(k, v) for k, v in self.map_attributes(data.attributes)])
+        plans = self.element_plans(xsd_element)
+        plan = plans.get(xsd_element) or self.element_plan(xsd_element, plans)
+
+        if data.attributes and plan["name"] is not None:
+            attr_prefix = plan["name"]
+            map_qname = self.map_qname
+            result_dict = self.dict([(attr_prefix + map_qname(k), v) for k, v in data.attributes])
         else:
             result_dict = self.dict()
-        if xsd_element.type.is_simple() or xsd_element.type.has_simple_content():
-            result_dict[xsd_element.local_name] = data.text if data.text is not None and data.text != "" else None
+        if plan["simple"]:
+            result_dict[plan["name"]] = data.text if data.text is not None and data.text != "" else None
 
         if data.content:
             for name, value, xsd_child in self.map_content(data.content):
                 if value:
-                    if xsd_child.local_name:
-                        name = xsd_child.local_name
+                    child_plan = plans.get(xsd_child) or self.element_plan(xsd_child, plans)
+
+                    if child_plan["name"]:
+                        name = child_plan["name"]
                     else:
                         name = name[2 + len(xsd_child.namespace):]
 
-                    if xsd_child.is_single():
-                        if hasattr(xsd_child, 'type') and (xsd_child.type.is_simple() or xsd_child.type.has_simple_content()):
+                    if child_plan["single"]:
+                        if child_plan["simple"]:
                             for k in value:
                                 result_dict[k] = value[k]
                         else:
                             result_dict[name] = value
                     else:
-                        if (xsd_child.type.is_simple() or xsd_child.type.has_simple_content()) and not xsd_child.attributes:
-                            if len(xsd_element.findall("*")) == 1:
+                        if child_plan["simple"] and not child_plan["attributes"]:
+                            if plan["child_count"] == 1:
                                 try:
                                     result_dict.append(list(value.values())[0])
                                 except AttributeError:
@@ -140,11 +209,25 @@ class ParqConverter(xmlschema.XMLSchemaConverter):
                             except AttributeError:
                                 result_dict[name] = self.list([value])
         if level == 0:
-            return self.dict([(xsd_element.local_name, result_dict)])
+            return self.dict([(plan["name"], result_dict)])
         else:
             return result_dict
 
 
+def get_schema(xsd_file):
+    """
+    :param xsd_file: xsd file
+    :return: xmlschema object, generated once per xsd file and process
+    """
+    try:
+        return _schemas[xsd_file]
+    except KeyError:
+        _logger.debug("Generating schema from " + xsd_file)
+        my_schema = xmlschema.XMLSchema(xsd_file, converter=ParqConverter)
+        _schemas[xsd_file] = my_schema
+        return my_schema
+
+
 def open_file(zip, filename):
     """
     :param zip: whether to open a new file using gzip
@@ -317,9 +400,7 @@ def parse_file(input_file, output_file, xsd_file, output_format, zip, xpath, att
     :param delete_xml: optional delete xml file after converting
     """
 
-    _logger.debug("Generating schema from " + xsd_file)
-
-    my_schema = xmlschema.XMLSchema(xsd_file, converter=ParqConverter)
+    my_schema = get_schema(xsd_file)
 
     _logger.debug("Parsing " + input_file)
 
@@ -475,7 +556,221 @@ def parse_file(input_file, output_file, xsd_file, output_format, zip, xpath, att
     _logger.debug("Completed " + input_file)
 
 
-def convert_xml_to_json(xsd_file=None, output_format="jsonl", server=None, target_path=None, zip=False, xpath=None, attribpaths=None, excludepaths=None, multi=1, no_overwrite=False, verbose="DEBUG", log=None, delete_xml=None, xml_files=None):
+def get_rss(pid):
+    """
+    :param pid: process id
+    :return: resident memory of the process in bytes, 0 if unknown
+    """
+    try:
+        with open("/proc/" + str(pid) + "/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+def get_available_memory():
+    """
+    :return: memory available to new processes in bytes, None if unknown
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def estimate_memory(input_file, xpath):
+    """
+    :param input_file: input file
+    :param xpath: whether to parse a specific xml path
+    :return: estimated peak memory in bytes to convert the file
+    """
+    size = os.path.getsize(input_file)
+
+    try:
+        if input_file.endswith(".zip"):
+            # members are parsed one at a time
+            with ZipFile(input_file, 'r') as zip_file:
+                size = max([info.file_size for info in zip_file.infolist()] or [0])
+        elif input_file.endswith(".gz"):
+            # gzip trailer holds the uncompressed size modulo 2^32
+            with open(input_file, "rb") as f:
+                f.seek(-4, os.SEEK_END)
+                isize = struct.unpack("<I", f.read(4))[0]
+            size = isize if isize >= size else size * _GZIP_SIZE_FACTOR
+    except (OSError, BadZipFile, struct.error) as ex:
+        # leave the real error to the worker parsing the file
+        _logger.debug("Could not estimate memory for " + input_file + ": " + repr(ex))
+        return _TASK_MEMORY_BASE + os.path.getsize(input_file) * _TREE_MEMORY_FACTOR
+
+    # without xpath the whole document tree and its dictionary are held in memory
+    factor = _XPATH_MEMORY_FACTOR if xpath else _TREE_MEMORY_FACTOR
+    return _TASK_MEMORY_BASE + size * factor
+
+
+def task_worker(func, conn, max_tasks, max_rss_growth):
+    """
+    :param func: function to call for each task
+    :param conn: pipe to the scheduler. Receives (task_id, args) tasks, None stops the worker. Sends (task_id, error, retired) results
+    :param max_tasks: retire after this many tasks
+    :param max_rss_growth: retire once resident memory grows by this many bytes
+    """
+    pid = os.getpid()
+    start_rss = get_rss(pid)
+    completed = 0
+
+    for task_id, args in iter(conn.recv, None):
+        error = None
+        try:
+            func(*args)
+        except (Exception, SystemExit) as ex:
+            error = repr(ex)
+        completed += 1
+
+        retired = bool(max_tasks and completed >= max_tasks) or bool(max_rss_growth and get_rss(pid) - start_rss > max_rss_growth)
+        conn.send((task_id, error, retired))
+        if retired:
+            break
+    conn.close()
+
+
+def schedule_tasks(func, tasks, multi, memory_budget=None, max_tasks=None, max_rss_growth=None):
+    """
+    :param func: function to call for each task
+    :param tasks: list of (args, estimated memory in bytes) in the order to run
+    :param multi: maximum number of concurrent workers
+    :param memory_budget: memory in bytes shared by all workers. Default is 80% of available memory
+    :param max_tasks: recycle a worker after this many tasks
+    :param max_rss_growth: recycle a worker once its resident memory grows by this many bytes
+    :return: list of (args, error) for failed tasks
+    """
+    if memory_budget is None:
+        available_memory = get_available_memory()
+        memory_budget = available_memory * 0.8 if available_memory else float("inf")
+
+    # workers are forked from this process so their memory is measured from here
+    base_rss = get_rss(os.getpid())
+
+    # (task_id, args, estimate, alone) where alone tasks only run with no other task
+    pending = deque([(task_id, args, estimate, False) for task_id, (args, estimate) in enumerate(tasks)])
+    workers = dict()
+    retried = set()
+    failed = []
+
+    def rss_growth(worker):
+        return max(get_rss(worker["process"].pid) - base_rss, 0)
+
+    def stop_worker(worker):
+        del workers[worker["process"].pid]
+        worker["process"].join()
+        worker["conn"].close()
+
+    def handle_result(worker):
+        # a worker killed part way through sending leaves a broken message, its death is handled below
+        try:
+            task_id, error, retired = worker["conn"].recv()
+        except (EOFError, OSError, pickle.UnpicklingError):
+            return
+        args = worker["task"][1]
+        worker["task"] = None
+        if error:
+            _logger.error("Failed " + str(args[0]) + ": " + error)
+            failed.append((args, error))
+        if retired:
+            _logger.debug("Recycling worker " + str(worker["process"].pid))
+            stop_worker(worker)
+
+    def handle_death(worker):
+        if worker["conn"].poll():
+            handle_result(worker)
+            if worker["process"].pid not in workers:
+                return
+        stop_worker(worker)
+        if worker["task"] is None:
+            return
+
+        task_id, args, estimate, alone = worker["task"]
+        exitcode = worker["process"].exitcode
+        if exitcode is not None and exitcode < 0 and task_id not in retried:
+            # retry once on its own in case it was killed for lack of memory
+            _logger.warning("Worker for " + str(args[0]) + " exited with code " + str(exitcode) + ". Retrying alone")
+            retried.add(task_id)
+            pending.appendleft((task_id, args, estimate, True))
+        else:
+            error = "worker exited with code " + str(exitcode)
+            _logger.error("Failed " + str(args[0]) + ": " + error)
+            failed.append((args, error))
+
+    completed = False
+    try:
+        while pending or workers:
+            # admit tasks in order while they fit in the memory budget
+            while pending:
+                busy = [w for w in workers.values() if w["task"] is not None]
+                idle = [w for w in workers.values() if w["task"] is None]
+                if not idle and len(workers) >= multi:
+                    break
+
+                task_id, args, estimate, alone = pending[0]
+                if busy and (alone or any(w["task"][3] for w in busy)):
+                    break
+                committed = sum(max(w["estimate"], rss_growth(w)) for w in busy) + sum(rss_growth(w) for w in idle)
+                if busy and committed + estimate > memory_budget:
+                    break
+
+                if idle:
+                    worker = idle[0]
+                else:
+                    conn, worker_conn = Pipe()
+                    process = Process(target=task_worker, args=(func, worker_conn, max_tasks, max_rss_growth), daemon=True)
+                    process.start()
+                    worker_conn.close()
+                    worker = {"process": process, "conn": conn, "task": None, "estimate": 0}
+                    workers[process.pid] = worker
+
+                pending.popleft()
+                worker["task"] = (task_id, args, estimate, alone)
+                worker["estimate"] = estimate
+                worker["conn"].send((task_id, args))
+
+            if not any(w["task"] is not None for w in workers.values()):
+                break
+
+            # wake on any result or worker death. The timeout re-checks the budget as worker memory changes
+            by_conn = {w["conn"]: w for w in workers.values()}
+            by_sentinel = {w["process"].sentinel: w for w in workers.values()}
+            ready = wait(list(by_conn) + list(by_sentinel), timeout=1)
+
+            for obj in ready:
+                if obj in by_conn and by_conn[obj]["process"].pid in workers:
+                    handle_result(by_conn[obj])
+            for obj in ready:
+                if obj in by_sentinel and by_sentinel[obj]["process"].pid in workers:
+                    # absorb workers that died, e.g. killed by the OOM killer
+                    handle_death(by_sentinel[obj])
+        completed = True
+    finally:
+        for worker in list(workers.values()):
+            if completed or worker["task"] is None:
+                try:
+                    worker["conn"].send(None)
+                except OSError:
+                    worker["process"].terminate()
+            else:
+                worker["process"].terminate()
+        for worker in list(workers.values()):
+            stop_worker(worker)
+
+    return failed
+
+
+def convert_xml_to_json(xsd_file=None, output_format="jsonl", server=None, target_path=None, zip=False, xpath=None, attribpaths=None, excludepaths=None, multi=1, no_overwrite=False, verbose="DEBUG", log=None, delete_xml=None, xml_files=None, memory_budget=None, max_tasks=None, max_rss_growth=None):
     """
     :param xsd_file: xsd file name
     :param output_format: jsonl or json
@@ -491,6 +786,10 @@ def convert_xml_to_json(xsd_file=None, output_format="jsonl", server=None, targe
     :param log: optional log file
     :param delete_xml: optional delete xml file after converting
     :param xml_files: list of xml_files
+    :param memory_budget: optional memory in MB shared by concurrent parsers. Default is 80% of available memory
+    :param max_tasks: optional number of files after which a parser process is recycled
+    :param max_rss_growth: optional memory growth in MB after which a parser process is recycled
+    :return: list of (args, error) for files that failed when parsed concurrently
 
     """
 
@@ -533,7 +832,9 @@ def convert_xml_to_json(xsd_file=None, output_format="jsonl", server=None, targe
     file_count = len(file_list)
 
     if multi > 1:
-        parse_queue_pool = Pool(processes=multi)
+        # generate the schema and its decoding plans before forking so workers, recycled ones included, inherit them
+        ParqConverter.build_element_plans(get_schema(xsd_file))
+        tasks = []
 
     _logger.info("Processing " + str(file_count) + " files")
 
@@ -585,10 +886,20 @@ def convert_xml_to_json(xsd_file=None, output_format="jsonl", server=None, targe
                 continue
 
         if multi > 1:
-            parse_queue_pool.apply_async(parse_file, args=(filename, output_file, xsd_file, output_format, zip, xpath, attribpaths, excludepaths, target_path, server, delete_xml), error_callback=_logger.info)
+            tasks.append(((filename, output_file, xsd_file, output_format, zip, xpath, attribpaths, excludepaths, target_path, server, delete_xml), estimate_memory(filename, xpath)))
         else:
             parse_file(filename, output_file, xsd_file, output_format, zip, xpath, attribpaths, excludepaths, target_path, server, delete_xml)
 
+    failed = []
     if multi > 1:
-        parse_queue_pool.close()
-        parse_queue_pool.join()
+        mb = 1024 * 1024
+        failed = schedule_tasks(parse_file, tasks, multi,
+                                memory_budget * mb if memory_budget is not None else None,
+                                max_tasks,
+                                max_rss_growth * mb if max_rss_growth is not None else None)
+        if failed:
+            _logger.error(str(len(failed)) + " of " + str(len(tasks)) + " files failed:")
+            for args, error in failed:
+                _logger.error(str(args[0]) + ": " + error)
+
+    return failed